@@ -1,17 +1,22 @@
 from flask import Flask, jsonify, request
 import yaml
 import carla
-import matplotlib.pyplot as plt
 from pymongo import MongoClient
-from models.World import World
+from models.World import World, create_world
+from models.FleetSnapshot import FLEET_FIELDS
+from models.StartupTimer import StartupTimer
+from models.TripWorker import TripWorkerPool
 import uuid
 import json
+import math
 import time
+import atexit
 
 AVAILABLE_CAR_BRAND = ['audi','mercedes', 'chevrolet', 'tesla', 'dodge', 'ford', 'lincoln','mini','volkswagen','toyota','nissan','bmw']
 AVAILABLE_CAR_REGEX = 'vehicle.(' + '|'.join(AVAILABLE_CAR_BRAND) + ').*'
 WAYPOINT_TO_MILES_RATIO = 1/400
 DEFAULT_NEARBY_CAR_COUNT = 5
+LOCATION_FORMAT_HINT = "Should be 'l1'~'l10', 'x,y', {'x': .., 'y': ..} or {'lat': .., 'lon': ..} on the map"
 
 def main():
     config = open('config.yaml', 'r')
@@ -67,24 +72,53 @@ def apply_world_settings(world, config):
 
 
 
-config = open('config.yaml', 'r')
-args = yaml.safe_load(config)
-carla_args = args['Carla']
-mongo_args = args['Mongo']
-location_args = args['Locations']
-node_args = args['Node']
+startup_timer = StartupTimer()
 
-mongo_client = MongoClient("mongodb+srv://%s:%s@%s/myFirstDatabase?retryWrites=true&w=majority"
-    % (mongo_args['username'], mongo_args['password'], mongo_args['uri']))
+with startup_timer.phase('config'):
+    config = open('config.yaml', 'r')
+    args = yaml.safe_load(config)
+    carla_args = args['Carla']
+    mongo_args = args['Mongo']
+    location_args = args['Locations']
+    worker_args = args.get('Workers', {})
+
+with startup_timer.phase('mongo_connect'):
+    mongo_uri = "mongodb+srv://%s:%s@%s/myFirstDatabase?retryWrites=true&w=majority" \
+        % (mongo_args['username'], mongo_args['password'], mongo_args['uri'])
+    mongo_client = MongoClient(mongo_uri)
+
+with startup_timer.phase('carla_connect'):
+    carla_client = carla.Client(carla_args['host'], carla_args['port'])
+    carla_world = carla_client.get_world()
+
+with startup_timer.phase('world_settings'):
+    apply_world_settings(carla_world, carla_args)
 
-carla_client = carla.Client(carla_args['host'], carla_args['port'])
-carla_world = carla_client.get_world()
-apply_world_settings(carla_world, carla_args)
-world = World(
-    carla_world,
-    mongo_client.get_database(mongo_args['database']),
-    node_args['url']
-)
+with startup_timer.phase('world_init'):
+    world = create_world(carla_client, mongo_client.get_database(mongo_args['database']), args)
+    world.start_idle_policy()
+
+# Trip commands go either to the in-process World or, in worker mode, to the
+# worker process that owns the vehicle
+with startup_timer.phase('trip_workers'):
+    if worker_args.get('count', 0) > 0:
+        trip_service = TripWorkerPool(
+            worker_args['count'],
+            args,
+            mongo_uri,
+            mongo_client.get_database(mongo_args['database']),
+            world
+        )
+        atexit.register(trip_service.shutdown)
+    else:
+        trip_service = world
+
+# Resume trips that were driving when the server last stopped
+with startup_timer.phase('trip_recovery'):
+    if trip_service is world:
+        print("Recovered trips: ", world.recover_trips())
+
+print("Startup phases: ", startup_timer.summary())
 
 
 
@@ -106,7 +140,7 @@ def add_vehicle():
 
 @app.route('/vehicle/<vehicle_id>/trip', methods=['GET'])
 def get_vehicle_trip(vehicle_id):
-    trip = world.get_vehicle_trip(int(vehicle_id))
+    trip = trip_service.get_vehicle_trip(int(vehicle_id))
     if trip:
         return jsonify(trip), 200
     return "No in progress trip", 404
@@ -126,16 +160,49 @@ def get_vehicle(vehicle_id):
         else:
             return "Failed to remove vehicle", 500
 
+# Optional query: cursor=<last vehicle_id>, limit=N, fields=vehicle_id,location
 @app.route('/vehicle/all', methods=['GET'])
 def get_all_vehicles():
-    return jsonify(world.get_all_vehicles()), 200
-
-#location=lN
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit')
+    fields = request.args.get('fields')
+    try:
+        cursor = int(cursor) if cursor is not None else None
+        limit = int(limit) if limit is not None else None
+    except ValueError:
+        return "cursor and limit should be integers", 400
+    if limit is not None and limit <= 0:
+        return "limit should be positive", 400
+    if fields:
+        fields = fields.split(',')
+        if any(f not in FLEET_FIELDS for f in fields):
+            return "fields should be a subset of " + ','.join(FLEET_FIELDS), 400
+
+    vehicles, next_cursor, etag = world.get_all_vehicles(cursor, limit, fields)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    # Without pagination the response keeps the original plain list format
+    if cursor is None and limit is None:
+        response = jsonify(vehicles)
+    else:
+        response = jsonify({
+            "vehicles": vehicles,
+            "next_cursor": next_cursor
+        })
+    response.set_etag(etag)
+    return response, 200
+
+#location=lN, location=x,y, x=..&y=.. or lat=..&lon=..
 @app.route('/trip/nearby', methods=["GET"])
 def get_nearby_vehicles():
     location = request.args.get('location')
+    if location is None:
+        location = request.args.to_dict()
     carla_location = location_to_carla_spawnpoint(location)
-    if not carla_location:
+    if carla_location is None:
         return "Incorrect location", 400
 
     nearby_cars = world.get_nearest_vehicles(
@@ -169,13 +236,13 @@ def initiate_trip():
     pickup_sp = location_to_carla_spawnpoint(pickup_location)
     destination_sp = location_to_carla_spawnpoint(destination)
 
-    if not pickup_sp:
-        return "Pickup location is not in correct format. Should be 'l1'~'l10'", 400
-    if not destination_sp:
-        return "Destination location is not in correct format. Should be 'l1'~'l10'", 400
+    if pickup_sp is None:
+        return "Pickup location is not in correct format. " + LOCATION_FORMAT_HINT, 400
+    if destination_sp is None:
+        return "Destination location is not in correct format. " + LOCATION_FORMAT_HINT, 400
 
     try:
-        error = world.trip_init(
+        error = trip_service.trip_init(
             vehicle_id,
             trip_id,
             pickup_sp,
@@ -188,7 +255,7 @@ def initiate_trip():
         return "Trip id already exists", 409
 
     try:
-        waypoint_count = world.trip_to_pickup(trip_id, crash)
+        waypoint_count = trip_service.trip_to_pickup(trip_id, crash)
 
         return jsonify({
             "pickup_eta": waypoint_count_to_eta(waypoint_count)
@@ -207,7 +274,7 @@ def trip_to_des():
     crash = bool(form['crash']) if 'crash' in form else False
 
     try:
-        waypoint_count = world.trip_to_destination(trip_id, crash)
+        waypoint_count = trip_service.trip_to_destination(trip_id, crash)
         return jsonify({
             "destination_eta": waypoint_count_to_eta(waypoint_count)
         }), 200
@@ -221,13 +288,42 @@ def trip_to_des():
 def trip_has_reached(trip_id):
     trip_id = int(trip_id)
     try:
-        status = world.trip_status(trip_id)
+        status = trip_service.trip_status(trip_id)
         if 'eta' in status:
             status['eta'] = waypoint_count_to_eta(status['eta'])
         return jsonify(status), 200
     except:
         return "Trip does not exist", 404
 
+# Archived per-tick telemetry of a finished trip, optionally downsampled
+@app.route('/trip/<trip_id>/trajectory', methods=['GET'])
+def get_trip_trajectory(trip_id):
+    max_points = request.args.get('max_points')
+    try:
+        max_points = int(max_points) if max_points is not None else None
+    except ValueError:
+        return "max_points should be an integer", 400
+    if max_points is not None and max_points <= 0:
+        return "max_points should be positive", 400
+
+    trajectory = world.get_trip_trajectory(int(trip_id), max_points)
+    if trajectory is None:
+        return "No archived trajectory for this trip", 404
+    return jsonify(trajectory), 200
+
+@app.route('/trip/<trip_id>/stats', methods=['GET'])
+def get_trip_trajectory_stats(trip_id):
+    stats = world.get_trip_trajectory_stats(int(trip_id))
+    if stats is None:
+        return "No archived trajectory for this trip", 404
+    return jsonify(stats), 200
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    stats = trip_service.get_stats()
+    stats['startup'] = startup_timer.summary()
+    return jsonify(stats), 200
+
 @app.route('/resetall', methods=['DELETE'])
 def reset_all():
     form = json.loads(request.get_data())
@@ -244,7 +340,26 @@ def reset_all():
 def waypoint_count_to_eta(waypoint_count):
     return 5*waypoint_count
 
+# Returns a spawn point index for the named locations, otherwise the
+# coordinate snapped to the nearest drivable lane point
 def location_to_carla_spawnpoint(location):
-    if location not in location_args:
-        return None
-    return location_args[location]
\ No newline at end of file
+    try:
+        if isinstance(location, str):
+            if location in location_args:
+                return location_args[location]
+            x, y = location.split(',')
+            return world.snap_to_road(*to_finite_floats(x, y))
+        if isinstance(location, dict):
+            if 'lat' in location and 'lon' in location:
+                return world.geolocation_to_road(*to_finite_floats(location['lat'], location['lon']))
+            if 'x' in location and 'y' in location:
+                return world.snap_to_road(*to_finite_floats(location['x'], location['y']))
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return None
+
+def to_finite_floats(*values):
+    floats = [float(v) for v in values]
+    if not all(math.isfinite(f) for f in floats):
+        raise ValueError("Coordinates should be finite numbers")
+    return floats
\ No newline at end of file
@@ -0,0 +1,264 @@
+"""Replay ride-hailing traffic against a running carlaServer.
+
+Seeds a fleet through POST /vehicle, then starts trips at a Poisson arrival
+rate. Every trip goes through /trip/nearby -> /trip/init -> /trip/status
+polling -> /trip/pickup -> /trip/status polling until FINISHED, using the
+l1~l10 locations from config.yaml.
+
+Example:
+    python loadgen.py --url http://127.0.0.1:5000 --vehicles 50 --rate 0.5 --duration 600
+"""
+import argparse
+import collections
+import json
+import math
+import random
+import threading
+import time
+
+import requests
+import yaml
+
+ENDPOINTS = ['vehicle', 'nearby', 'init', 'status', 'pickup', 'stats']
+
+
+class LoadStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.trips_started = 0
+        self.trips_completed = 0
+        self.trips_failed = 0
+        self.trip_durations = []
+        self.tick_lag_p99 = []
+        self.tick_lag_max = 0
+
+    def record(self, endpoint, latency, ok):
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.latencies[endpoint].append(latency)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def trip_started(self):
+        with self.lock:
+            self.trips_started += 1
+
+    def trip_finished(self, duration, ok):
+        with self.lock:
+            if ok:
+                self.trips_completed += 1
+                self.trip_durations.append(duration)
+            else:
+                self.trips_failed += 1
+
+
+class LoadGenerator(object):
+    def __init__(self, args, locations):
+        self.url = args.url.rstrip('/')
+        self.args = args
+        self.locations = locations
+        self.stats = LoadStats()
+        self.session = requests.Session()
+        self.vehicle_ids = []
+        self.idle_vehicles = set()
+        self.vehicle_lock = threading.Lock()
+        self.next_trip_id = args.start_trip_id
+        self.trip_id_lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def call(self, endpoint, method, path, body=None, params=None):
+        start = time.time()
+        try:
+            response = self.session.request(
+                method,
+                self.url + path,
+                data=json.dumps(body) if body is not None else None,
+                params=params,
+                timeout=self.args.request_timeout
+            )
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response = None
+            ok = False
+        self.stats.record(endpoint, time.time() - start, ok)
+        return response if ok else None
+
+    def seed_vehicles(self):
+        for i in range(self.args.vehicles):
+            vehicle_id = self.args.start_vehicle_id + i
+            if self.call('vehicle', 'POST', '/vehicle', {'vehicle_id': vehicle_id}):
+                self.vehicle_ids.append(vehicle_id)
+        self.idle_vehicles = set(self.vehicle_ids)
+        print("Seeded %d/%d vehicles" % (len(self.vehicle_ids), self.args.vehicles))
+
+    def claim_vehicle(self, nearby_cars):
+        with self.vehicle_lock:
+            for car in nearby_cars:
+                if car['vehicle_id'] in self.idle_vehicles:
+                    self.idle_vehicles.remove(car['vehicle_id'])
+                    return car['vehicle_id']
+        return None
+
+    def release_vehicle(self, vehicle_id):
+        with self.vehicle_lock:
+            self.idle_vehicles.add(vehicle_id)
+
+    def new_trip_id(self):
+        with self.trip_id_lock:
+            trip_id = self.next_trip_id
+            self.next_trip_id += 1
+            return trip_id
+
+    def wait_for_status(self, trip_id, expected, deadline):
+        while time.time() < deadline and not self.stopping.is_set():
+            response = self.call('status', 'GET', '/trip/status/%d' % trip_id)
+            if response is not None and response.json().get('status') in expected:
+                return True
+            time.sleep(self.args.poll_interval)
+        return False
+
+    def run_trip(self):
+        pickup, destination = random.sample(self.locations, 2)
+        start = time.time()
+        deadline = start + self.args.trip_timeout
+
+        response = self.call('nearby', 'GET', '/trip/nearby', params={'location': pickup})
+        if response is None:
+            self.stats.trip_finished(0, False)
+            return
+        vehicle_id = self.claim_vehicle(response.json())
+        if vehicle_id is None:
+            self.stats.trip_finished(0, False)
+            return
+
+        trip_id = self.new_trip_id()
+        self.stats.trip_started()
+        ok = False
+        try:
+            ok = self.call('init', 'POST', '/trip/init', {
+                'vehicle_id': vehicle_id,
+                'trip_id': trip_id,
+                'pickup_location': pickup,
+                'destination': destination
+            }) is not None
+            ok = ok and self.wait_for_status(trip_id, ('AT_PICKUP',), deadline)
+            ok = ok and self.call('pickup', 'POST', '/trip/pickup', {'trip_id': trip_id}) is not None
+            ok = ok and self.wait_for_status(trip_id, ('FINISHED',), deadline)
+        finally:
+            self.stats.trip_finished(time.time() - start, ok)
+            # A failed or timed out trip may still be running on the server,
+            # so only vehicles whose trip reached FINISHED are reused
+            if ok:
+                self.release_vehicle(vehicle_id)
+
+    def sample_server_stats(self):
+        while not self.stopping.wait(self.args.stats_interval):
+            response = self.call('stats', 'GET', '/stats')
+            if response is None:
+                continue
+            server_stats = response.json()
+            with self.stats.lock:
+                self.stats.tick_lag_p99.append(server_stats.get('tick_lag_p99', 0))
+                self.stats.tick_lag_max = max(self.stats.tick_lag_max, server_stats.get('tick_lag_max', 0))
+
+    def run(self):
+        self.seed_vehicles()
+        if not self.vehicle_ids:
+            print("No vehicles could be created, aborting")
+            return
+
+        sampler = threading.Thread(target=self.sample_server_stats, daemon=True)
+        sampler.start()
+
+        trip_threads = []
+        start = time.time()
+        end = start + self.args.duration
+        while time.time() < end:
+            time.sleep(random.expovariate(self.args.rate))
+            trip_threads = [t for t in trip_threads if t.is_alive()]
+            if len(trip_threads) >= self.args.max_concurrent:
+                continue
+            t = threading.Thread(target=self.run_trip, daemon=True)
+            t.start()
+            trip_threads.append(t)
+
+        # Give in-flight trips a chance to finish before reporting
+        drain_deadline = time.time() + self.args.drain_timeout
+        for t in trip_threads:
+            t.join(max(0, drain_deadline - time.time()))
+        elapsed = time.time() - start
+        self.stopping.set()
+
+        self.report(elapsed)
+        if self.args.cleanup:
+            self.remove_vehicles()
+
+    def remove_vehicles(self):
+        for vehicle_id in self.vehicle_ids:
+            self.call('vehicle', 'DELETE', '/vehicle/%d' % vehicle_id)
+
+    def report(self, elapsed):
+        s = self.stats
+        status_latencies = sorted(s.latencies['status'])
+        print("")
+        print("Duration:           %.1f s" % elapsed)
+        print("Trips started:      %d" % s.trips_started)
+        print("Trips completed:    %d" % s.trips_completed)
+        print("Trips failed:       %d" % s.trips_failed)
+        print("Sustained trips/s:  %.3f" % (s.trips_completed / elapsed if elapsed else 0))
+        if s.trip_durations:
+            print("Trip duration p50:  %.1f s" % percentile(sorted(s.trip_durations), 50))
+        print("Status p50:         %.1f ms" % (1000 * percentile(status_latencies, 50)))
+        print("Status p99:         %.1f ms" % (1000 * percentile(status_latencies, 99)))
+        print("Tick lag p99:       %.1f ms (worst sample)" % (1000 * max(s.tick_lag_p99 or [0])))
+        print("Tick lag max:       %.1f ms" % (1000 * s.tick_lag_max))
+        print("")
+        print("%-10s %8s %8s %8s %10s" % ('endpoint', 'requests', 'errors', 'err %', 'p99 ms'))
+        for endpoint in ENDPOINTS:
+            count = s.requests[endpoint]
+            if not count:
+                continue
+            print("%-10s %8d %8d %7.2f%% %10.1f" % (
+                endpoint,
+                count,
+                s.errors[endpoint],
+                100.0 * s.errors[endpoint] / count,
+                1000 * percentile(sorted(s.latencies[endpoint]), 99)
+            ))
+
+
+# Nearest-rank percentile of an already sorted list, same as World.percentile
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    index = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(index, len(sorted_values) - 1))]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay ride-hailing traffic against carlaServer')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='carlaServer base url')
+    parser.add_argument('--config', default='config.yaml', help='config file with the Locations map')
+    parser.add_argument('--vehicles', type=int, default=20, help='number of vehicles to seed')
+    parser.add_argument('--rate', type=float, default=0.2, help='trip arrival rate (trips/sec)')
+    parser.add_argument('--duration', type=float, default=300, help='seconds to generate arrivals for')
+    parser.add_argument('--max-concurrent', type=int, default=100, help='cap on in-flight trips')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='seconds between status polls')
+    parser.add_argument('--trip-timeout', type=float, default=900, help='seconds before a trip counts as failed')
+    parser.add_argument('--drain-timeout', type=float, default=300, help='seconds to wait for in-flight trips')
+    parser.add_argument('--request-timeout', type=float, default=30, help='per request timeout in seconds')
+    parser.add_argument('--stats-interval', type=float, default=5, help='seconds between /stats samples')
+    parser.add_argument('--start-vehicle-id', type=int, default=900000, help='first seeded vehicle id')
+    parser.add_argument('--start-trip-id', type=int, default=900000, help='first generated trip id')
+    parser.add_argument('--cleanup', action='store_true', help='remove seeded vehicles when done')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with open(args.config, 'r') as config:
+        locations = list(yaml.safe_load(config)['Locations'].keys())
+    LoadGenerator(args, locations).run()
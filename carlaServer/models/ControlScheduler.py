@@ -0,0 +1,139 @@
+import time
+import itertools
+import threading
+
+ACTOR_IDS_REFRESH = 5 # seconds between actor list refreshes
+# Actors BehaviorAgent reacts to, so they force full rate when close
+DEFAULT_ACTOR_FILTERS = ['vehicle.*', 'walker.pedestrian.*']
+
+
+class FullRatePolicy(object):
+    """Steps every vehicle on every tick."""
+
+    def step_interval(self, scheduler, vehicle, waypoints_queue):
+        return 1
+
+
+class ManeuverProximityPolicy(object):
+    """Steps at full rate near junctions, other actors or the stop point,
+    and every reduced_interval ticks on simple road segments."""
+
+    def __init__(self, reduced_interval=4, junction_lookahead=30, actor_radius=25.0, stop_waypoints=60):
+        self.reduced_interval = reduced_interval
+        self.junction_lookahead = junction_lookahead
+        self.actor_radius = actor_radius
+        self.stop_waypoints = stop_waypoints
+
+    def step_interval(self, scheduler, vehicle, waypoints_queue):
+        if len(waypoints_queue) <= self.stop_waypoints:
+            return 1
+
+        for waypoint, _ in itertools.islice(waypoints_queue, self.junction_lookahead):
+            if waypoint.is_junction:
+                return 1
+
+        if scheduler.has_actor_nearby(vehicle.id, self.actor_radius):
+            return 1
+
+        return self.reduced_interval
+
+
+CONTROL_POLICIES = {
+    'full': FullRatePolicy,
+    'maneuver_proximity': ManeuverProximityPolicy
+}
+
+
+class ControlScheduler(object):
+    """Decides on which ticks a trip runs agent.run_step() and writes
+    telemetry, and counts how many steps were saved."""
+
+    def __init__(self, carla_world, policy=None, actor_filters=None):
+        self.world = carla_world
+        self.policy = policy or FullRatePolicy()
+        self.actor_filters = actor_filters or DEFAULT_ACTOR_FILTERS
+        self.lock = threading.Lock()
+        self.steps_run = 0
+        self.steps_skipped = 0
+
+        self.actor_ids = []
+        self.actor_ids_time = 0
+        self.locations_frame = None
+        self.locations = {}
+
+    def new_schedule(self):
+        return TripSchedule(self)
+
+    def has_actor_nearby(self, actor_id, radius):
+        locations = self.get_actor_locations()
+        own_location = locations.get(actor_id)
+        if own_location is None:
+            return False
+        for other_id, location in locations.items():
+            if other_id != actor_id and own_location.distance(location) <= radius:
+                return True
+        return False
+
+    # Tracked actor locations for the current frame, shared by every trip
+    def get_actor_locations(self):
+        snapshot = self.world.get_snapshot()
+        with self.lock:
+            if snapshot.frame == self.locations_frame:
+                return self.locations
+
+            if time.time() - self.actor_ids_time > ACTOR_IDS_REFRESH:
+                actors = self.world.get_actors()
+                self.actor_ids = [a.id for f in self.actor_filters for a in actors.filter(f)]
+                self.actor_ids_time = time.time()
+
+            locations = {}
+            for actor_id in self.actor_ids:
+                actor_snapshot = snapshot.find(actor_id)
+                if actor_snapshot:
+                    locations[actor_id] = actor_snapshot.get_transform().location
+            self.locations = locations
+            self.locations_frame = snapshot.frame
+            return locations
+
+    def record(self, run):
+        with self.lock:
+            if run:
+                self.steps_run += 1
+            else:
+                self.steps_skipped += 1
+
+    def get_stats(self):
+        with self.lock:
+            total = self.steps_run + self.steps_skipped
+            return {
+                "policy": type(self.policy).__name__,
+                "steps_run": self.steps_run,
+                "steps_skipped": self.steps_skipped,
+                "saved_ratio": self.steps_skipped / total if total else 0
+            }
+
+
+class TripSchedule(object):
+    """Per-trip state of the control scheduler."""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.ticks_until_step = 0
+
+    def should_step(self, vehicle, waypoints_queue):
+        if self.ticks_until_step > 0:
+            self.ticks_until_step -= 1
+            self.scheduler.record(False)
+            return False
+
+        interval = self.scheduler.policy.step_interval(self.scheduler, vehicle, waypoints_queue)
+        self.ticks_until_step = max(1, interval) - 1
+        self.scheduler.record(True)
+        return True
+
+
+def create_control_scheduler(carla_world, config=None):
+    config = dict(config or {})
+    policy_class = CONTROL_POLICIES[config.pop('policy', 'full')]
+    actor_filters = config.pop('actor_filters', None)
+    return ControlScheduler(carla_world, policy_class(**config), actor_filters)
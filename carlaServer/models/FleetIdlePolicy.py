@@ -0,0 +1,126 @@
+import time
+import logging
+import carla
+from .StoppableThread import StoppableThread
+
+DEFAULT_DORMANCY_RADIUS = 200.0
+DEFAULT_UPDATE_INTERVAL = 2.0
+
+
+class FleetIdlePolicy(object):
+    """Decides how idle fleet vehicles are simulated.
+
+    Idle vehicles are handed to a dedicated Traffic Manager, optionally in
+    hybrid physics mode. With dormancy enabled, idle vehicles farther than
+    dormancy_radius from every vehicle in a trip are frozen (autopilot and
+    physics off) until a trip comes close again or claims them."""
+
+    def __init__(self, carla_client=None, config=None):
+        config = config or {}
+        self.client = carla_client
+        self.tm_port = config.get('traffic_manager_port')
+        self.dormancy = config.get('dormancy', False) and carla_client is not None
+        self.dormancy_radius = config.get('dormancy_radius', DEFAULT_DORMANCY_RADIUS)
+        self.update_interval = config.get('update_interval', DEFAULT_UPDATE_INTERVAL)
+        self.dormant = set()
+        self.update_thread = None
+
+        if carla_client is not None and self.tm_port:
+            traffic_manager = carla_client.get_trafficmanager(self.tm_port)
+            # No fleet vehicle is a hero, so every vehicle on this traffic
+            # manager runs without physics
+            if config.get('hybrid_physics', False):
+                traffic_manager.set_hybrid_physics_mode(True)
+
+    def set_autopilot(self, actor, enabled):
+        if self.tm_port:
+            actor.set_autopilot(enabled, self.tm_port)
+        else:
+            actor.set_autopilot(enabled)
+
+    # Vehicle becomes idle: hand it back to the traffic manager
+    def release(self, actor):
+        self.dormant.discard(actor.id)
+        actor.set_simulate_physics(True)
+        self.set_autopilot(actor, True)
+
+    # Vehicle is taken by a trip: take it from the traffic manager first,
+    # then make sure it is fully simulated
+    def claim(self, actor):
+        self.dormant.discard(actor.id)
+        self.set_autopilot(actor, False)
+        actor.set_simulate_physics(True)
+
+    def start(self, carla_world, get_fleet):
+        """Start the dormancy updater. get_fleet returns two lists of carla
+        actor ids: (idle vehicles, vehicles in a trip)."""
+        if not self.dormancy or self.update_thread is not None:
+            return
+        self.update_thread = StoppableThread(target=self.run_updates, args=(carla_world, get_fleet), daemon=True)
+        self.update_thread.start()
+
+    def stop(self):
+        if self.update_thread is not None:
+            self.update_thread.stop()
+
+    def run_updates(self, carla_world, get_fleet):
+        while not self.update_thread.stopped():
+            try:
+                idle_ids, active_ids = get_fleet()
+                self.update_dormancy(carla_world.get_snapshot(), idle_ids, active_ids)
+            except Exception as e:
+                logging.warning("Fleet idle policy update failed: %s" % e)
+            time.sleep(self.update_interval)
+
+    def update_dormancy(self, snapshot, idle_ids, active_ids):
+        # A claim can race with an earlier update or happen in another
+        # process, so vehicles this process froze and that are now in a trip
+        # are explicitly given their physics back
+        claimed = self.dormant & set(active_ids)
+        if claimed:
+            self.client.apply_batch([carla.command.SetSimulatePhysics(actor_id, True) for actor_id in claimed])
+            self.dormant.difference_update(claimed)
+
+        # Positions come from the world snapshot, so there is no per-actor RPC
+        active_locations = []
+        for actor_id in active_ids:
+            actor_snapshot = snapshot.find(actor_id)
+            if actor_snapshot:
+                active_locations.append(actor_snapshot.get_transform().location)
+
+        to_sleep = []
+        to_wake = []
+        for actor_id in idle_ids:
+            actor_snapshot = snapshot.find(actor_id)
+            if not actor_snapshot:
+                continue
+            location = actor_snapshot.get_transform().location
+            near_trip = any(location.distance(l) <= self.dormancy_radius for l in active_locations)
+            if near_trip and actor_id in self.dormant:
+                to_wake.append(actor_id)
+            elif not near_trip and actor_id not in self.dormant:
+                to_sleep.append(actor_id)
+
+        commands = []
+        for actor_id in to_sleep:
+            commands.append(self.autopilot_command(actor_id, False))
+            commands.append(carla.command.SetSimulatePhysics(actor_id, False))
+        for actor_id in to_wake:
+            commands.append(carla.command.SetSimulatePhysics(actor_id, True))
+            commands.append(self.autopilot_command(actor_id, True))
+        if commands:
+            self.client.apply_batch(commands)
+
+        self.dormant.update(to_sleep)
+        self.dormant.difference_update(to_wake)
+
+    def autopilot_command(self, actor_id, enabled):
+        if self.tm_port:
+            return carla.command.SetAutopilot(actor_id, enabled, self.tm_port)
+        return carla.command.SetAutopilot(actor_id, enabled)
+
+    def get_stats(self):
+        return {
+            "dormancy": self.dormancy,
+            "dormant_vehicles": len(self.dormant)
+        }
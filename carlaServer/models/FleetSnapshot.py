@@ -0,0 +1,106 @@
+import bisect
+import hashlib
+import json
+import threading
+
+FLEET_FIELDS = ['vehicle_id', 'carla_id', 'carla_type_id', 'attributes', 'location']
+
+
+class FleetSnapshot(object):
+    """In-memory view of the fleet for listings. Static vehicle info is kept
+    from add/remove calls and locations are read from the world snapshot,
+    rebuilt at most once per simulator tick. Listing the fleet therefore does
+    not touch Mongo or make per-actor RPCs."""
+
+    def __init__(self, carla_world, mongo_db):
+        self.world = carla_world
+        self.mongo_db = mongo_db
+        self.lock = threading.Lock()
+        self.vehicles = None
+        self.version = 0
+        self.frame = None
+        self.built_version = None
+        self.entries = []
+        self.vehicle_ids = []
+
+    def load(self):
+        # Called with the lock held, once, on first use
+        records = list(self.mongo_db.vehicles.find({"destroyed": False}, {"vehicle_id": 1, "carla_actor_id": 1}))
+        actors = self.world.get_actors([r['carla_actor_id'] for r in records])
+        actors_by_id = {a.id: a for a in actors}
+        self.vehicles = {}
+        for r in records:
+            actor = actors_by_id.get(r['carla_actor_id'])
+            if actor:
+                self.vehicles[r['vehicle_id']] = static_info(r['vehicle_id'], actor)
+
+    def add(self, vehicle_id, actor):
+        with self.lock:
+            if self.vehicles is not None:
+                self.vehicles[vehicle_id] = static_info(vehicle_id, actor)
+                self.version += 1
+
+    def remove(self, vehicle_id):
+        with self.lock:
+            if self.vehicles is not None:
+                self.vehicles.pop(vehicle_id, None)
+                self.version += 1
+
+    def clear(self):
+        with self.lock:
+            self.vehicles = {}
+            self.version += 1
+
+    def get(self):
+        """Returns (entries sorted by vehicle_id, sorted vehicle ids)."""
+        snapshot = self.world.get_snapshot()
+        with self.lock:
+            if self.vehicles is None:
+                self.load()
+            if snapshot.frame != self.frame or self.version != self.built_version:
+                self.build(snapshot)
+            return self.entries, self.vehicle_ids
+
+    def build(self, snapshot):
+        entries = []
+        for vehicle_id in sorted(self.vehicles.keys()):
+            info = self.vehicles[vehicle_id]
+            actor_snapshot = snapshot.find(info['carla_id'])
+            if not actor_snapshot:
+                continue
+            location = actor_snapshot.get_transform().location
+            entry = dict(info)
+            entry['location'] = '(%f, %f)' % (location.x, location.y)
+            entries.append(entry)
+
+        self.entries = entries
+        self.vehicle_ids = [e['vehicle_id'] for e in entries]
+        self.frame = snapshot.frame
+        self.built_version = self.version
+
+    def get_page(self, cursor=None, limit=None, fields=None):
+        """Returns (vehicles, next_cursor, etag). The cursor is the last
+        vehicle_id of the previous page. The etag only covers the query and
+        the projected page, so listings without locations stay valid across
+        ticks."""
+        entries, vehicle_ids = self.get()
+        start = bisect.bisect_right(vehicle_ids, cursor) if cursor is not None else 0
+        end = len(entries) if limit is None else min(len(entries), start + limit)
+
+        page = entries[start:end]
+        if fields:
+            page = [{f: e[f] for f in fields} for e in page]
+        next_cursor = vehicle_ids[end - 1] if end < len(entries) and end > start else None
+        etag = hashlib.md5(json.dumps(
+            [cursor, limit, fields, next_cursor, page], sort_keys=True, default=str
+        ).encode()).hexdigest()
+        return page, next_cursor, etag
+
+
+def static_info(vehicle_id, actor):
+    return {
+        "vehicle_id": vehicle_id,
+        "carla_id": actor.id,
+        "carla_type_id": actor.type_id,
+        "attributes": actor.attributes
+    }
@@ -0,0 +1,126 @@
+import math
+import collections
+import numpy as np
+
+DEFAULT_CELL_SIZE = 20.0 # meters
+DEFAULT_MAX_SNAP_DISTANCE = 300.0 # meters, farther points are off the map
+
+
+class RoadIndex(object):
+    """Uniform grid over the map's driving lane waypoints, used to snap an
+    arbitrary (x, y) to the nearest drivable point without calling
+    map.get_waypoint per request."""
+
+    def __init__(self, lane_waypoints, cell_size=DEFAULT_CELL_SIZE, max_snap_distance=DEFAULT_MAX_SNAP_DISTANCE):
+        # lane_waypoints: list of (x, y, z)
+        self.points = np.array(lane_waypoints, dtype=np.float64).reshape(-1, 3)
+        self.cell_size = cell_size
+        self.max_snap_distance = max_snap_distance
+
+        cells = collections.defaultdict(list)
+        for i, (x, y, _) in enumerate(self.points):
+            cells[self.cell_of(x, y)].append(i)
+        self.cells = {k: np.array(v, dtype=np.int64) for k, v in cells.items()}
+
+        if self.cells:
+            keys = np.array(list(self.cells.keys()))
+            self.bounds = (keys[:, 0].min(), keys[:, 0].max(), keys[:, 1].min(), keys[:, 1].max())
+        else:
+            self.bounds = None
+
+    def cell_of(self, x, y):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def nearest(self, x, y):
+        """Returns (x, y, z) of the closest lane waypoint, or None if the
+        index is empty or nothing is within max_snap_distance."""
+        if self.bounds is None:
+            return None
+
+        cx, cy = self.cell_of(x, y)
+        min_x, max_x, min_y, max_y = self.bounds
+        if not (min_x <= cx <= max_x and min_y <= cy <= max_y):
+            # Outside the map the ring search would mostly visit empty cells
+            distances = (self.points[:, 0] - x) ** 2 + (self.points[:, 1] - y) ** 2
+            best_index = int(np.argmin(distances))
+            return self.snapped(best_index, math.sqrt(distances[best_index]))
+
+        # Rings past max_ring only hold points farther than max_snap_distance
+        max_ring = min(
+            int(max(cx - min_x, max_x - cx, cy - min_y, max_y - cy)),
+            int(math.ceil(self.max_snap_distance / self.cell_size)) + 1
+        )
+        best_index = None
+        best_distance = float('inf')
+
+        for ring in range(max_ring + 1):
+            # Points in this ring or beyond are at least (ring - 1) * cell_size away
+            if best_index is not None and best_distance <= (ring - 1) * self.cell_size:
+                break
+            for cell in ring_cells(cx, cy, ring):
+                indexes = self.cells.get(cell)
+                if indexes is None:
+                    continue
+                candidates = self.points[indexes]
+                distances = (candidates[:, 0] - x) ** 2 + (candidates[:, 1] - y) ** 2
+                i = int(np.argmin(distances))
+                if distances[i] < best_distance ** 2:
+                    best_index = int(indexes[i])
+                    best_distance = math.sqrt(distances[i])
+
+        return self.snapped(best_index, best_distance)
+
+    def snapped(self, index, distance):
+        if index is None or distance > self.max_snap_distance:
+            return None
+        return tuple(float(v) for v in self.points[index])
+
+
+class GeoReference(object):
+    """Linear lat/lon <-> map coordinate conversion fitted from
+    map.transform_to_geolocation. Accurate at town scale."""
+
+    def __init__(self, origin, d_east, d_north):
+        # origin: (lat, lon) of map (0, 0); d_east / d_north: (dlat, dlon) per meter of x / y
+        self.origin = origin
+        self.d_x = d_east
+        self.d_y = d_north
+
+    def to_map(self, lat, lon):
+        dlat = lat - self.origin[0]
+        dlon = lon - self.origin[1]
+        det = self.d_x[0] * self.d_y[1] - self.d_y[0] * self.d_x[1]
+        x = (dlat * self.d_y[1] - self.d_y[0] * dlon) / det
+        y = (self.d_x[0] * dlon - dlat * self.d_x[1]) / det
+        return x, y
+
+    def to_list(self):
+        return [list(self.origin), list(self.d_x), list(self.d_y)]
+
+    @staticmethod
+    def from_list(values):
+        return GeoReference(tuple(values[0]), tuple(values[1]), tuple(values[2]))
+
+    @staticmethod
+    def fit(carla_map, span=1000.0):
+        import carla
+        origin = carla_map.transform_to_geolocation(carla.Location(x=0, y=0, z=0))
+        east = carla_map.transform_to_geolocation(carla.Location(x=span, y=0, z=0))
+        north = carla_map.transform_to_geolocation(carla.Location(x=0, y=span, z=0))
+        return GeoReference(
+            (origin.latitude, origin.longitude),
+            ((east.latitude - origin.latitude) / span, (east.longitude - origin.longitude) / span),
+            ((north.latitude - origin.latitude) / span, (north.longitude - origin.longitude) / span)
+        )
+
+
+def ring_cells(cx, cy, ring):
+    if ring == 0:
+        yield (cx, cy)
+        return
+    for dx in range(-ring, ring + 1):
+        yield (cx + dx, cy - ring)
+        yield (cx + dx, cy + ring)
+    for dy in range(-ring + 1, ring):
+        yield (cx - ring, cy + dy)
+        yield (cx + ring, cy + dy)
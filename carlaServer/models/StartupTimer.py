@@ -0,0 +1,27 @@
+import time
+import logging
+from contextlib import contextmanager
+
+
+class StartupTimer(object):
+    """Records how long each startup phase takes so restart-to-serving
+    time can be measured."""
+
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        phase_start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - phase_start
+            self.phases.append((name, duration))
+            logging.info("Startup phase [%s] took %.3f seconds" % (name, duration))
+
+    def summary(self):
+        return {
+            "phases": dict(self.phases),
+            "total": sum(d for _, d in self.phases)
+        }
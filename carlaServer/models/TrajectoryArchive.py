@@ -0,0 +1,161 @@
+import os
+import re
+import math
+import time
+import logging
+import threading
+import numpy as np
+
+TRIP_LEGS = ['pickup', 'destination']
+
+# Column name and dtype, in the order rows are recorded
+TRAJECTORY_FIELDS = [
+    ('timestamp', np.float64),
+    ('x', np.float32),
+    ('y', np.float32),
+    ('speed', np.float32),
+    ('heading', np.float32),
+    ('throttle', np.float32),
+    ('steer', np.float32),
+    ('brake', np.float32),
+    ('collision', np.float32)
+]
+TRAJECTORY_FIELD_NAMES = [name for name, _ in TRAJECTORY_FIELDS]
+
+
+class TrajectoryArchive(object):
+    """Per-trip columnar telemetry archive. Every run of trace_route writes
+    one segment of a leg, as one NumPy array per field under
+    <archive_dir>/<trip_id>/<leg>/<segment>/<field>.npy. A leg resumed after
+    a restart adds a segment instead of overwriting the earlier rows. Reads
+    memory-map only the columns they need, one segment at a time."""
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+
+    def new_recorder(self, trip_id, leg):
+        return TrajectoryRecorder(self, trip_id, leg)
+
+    def get_leg_dir(self, trip_id, leg):
+        return os.path.join(self.archive_dir, safe_name(trip_id), leg)
+
+    def get_segments(self, leg_dir):
+        if not os.path.isdir(leg_dir):
+            return []
+        return sorted(int(name) for name in os.listdir(leg_dir) if name.isdigit())
+
+    def write(self, trip_id, leg, rows):
+        leg_dir = self.get_leg_dir(trip_id, leg)
+        segments = self.get_segments(leg_dir)
+        segment_dir = os.path.join(leg_dir, str(segments[-1] + 1 if segments else 0))
+        tmp_dir = segment_dir + '.tmp'
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            for i, (name, dtype) in enumerate(TRAJECTORY_FIELDS):
+                np.save(os.path.join(tmp_dir, name + '.npy'), np.array([r[i] for r in rows], dtype=dtype))
+            os.rename(tmp_dir, segment_dir)
+        except OSError as e:
+            logging.warning("Failed to archive trajectory of trip %s: %s" % (trip_id, e))
+
+    def load_segments(self, trip_id, fields):
+        """Returns, in time order, a dict of field name to memory-mapped
+        column per archived segment. Only the requested fields are opened."""
+        segments = []
+        for leg in TRIP_LEGS:
+            leg_dir = self.get_leg_dir(trip_id, leg)
+            for segment in self.get_segments(leg_dir):
+                segment_dir = os.path.join(leg_dir, str(segment))
+                segments.append({
+                    name: np.load(os.path.join(segment_dir, name + '.npy'), mmap_mode='r')
+                    for name in fields
+                })
+        return segments
+
+    def get_trajectory(self, trip_id, max_points=None):
+        if max_points is not None and max_points <= 0:
+            raise ValueError("max_points should be positive")
+
+        segments = self.load_segments(trip_id, TRAJECTORY_FIELD_NAMES)
+        if not segments:
+            return None
+
+        total = sum(len(segment['timestamp']) for segment in segments)
+        step = int(math.ceil(total / max_points)) if max_points and total > max_points else 1
+
+        # Keep one stride across segments; offset is where the next segment's
+        # first sampled row falls
+        points = []
+        offset = 0
+        for segment in segments:
+            length = len(segment['timestamp'])
+            columns = {name: segment[name][offset::step] for name in TRAJECTORY_FIELD_NAMES}
+            for i in range(len(columns['timestamp'])):
+                points.append({name: float(columns[name][i]) for name in TRAJECTORY_FIELD_NAMES})
+            offset = (offset - length) % step
+        return points
+
+    def get_stats(self, trip_id):
+        segments = self.load_segments(trip_id, ['timestamp', 'x', 'y', 'speed', 'collision'])
+        if not segments:
+            return None
+
+        segments = [segment for segment in segments if len(segment['timestamp'])]
+        if not segments:
+            return {"points": 0}
+
+        points = sum(len(segment['timestamp']) for segment in segments)
+        distance = 0.0
+        speed_sum = 0.0
+        for segment in segments:
+            x = np.asarray(segment['x'], dtype=np.float64)
+            y = np.asarray(segment['y'], dtype=np.float64)
+            distance += float(np.hypot(np.diff(x), np.diff(y)).sum())
+            speed_sum += float(np.asarray(segment['speed'], dtype=np.float64).sum())
+
+        return {
+            "points": points,
+            "start_time": float(segments[0]['timestamp'][0]),
+            "end_time": float(segments[-1]['timestamp'][-1]),
+            "duration": float(segments[-1]['timestamp'][-1] - segments[0]['timestamp'][0]),
+            "distance": distance,
+            "avg_speed": speed_sum / points,
+            "max_speed": max(float(np.max(segment['speed'])) for segment in segments),
+            "max_collision": max(float(np.max(segment['collision'])) for segment in segments)
+        }
+
+
+class TrajectoryRecorder(object):
+    """Buffers one trip leg's telemetry in memory until save()."""
+
+    def __init__(self, archive, trip_id, leg):
+        self.archive = archive
+        self.trip_id = trip_id
+        self.leg = leg
+        self.rows = []
+        self.lock = threading.Lock()
+
+    def record(self, vehicle_log):
+        collision = max([c[0] for c in vehicle_log['Collision']] or [0])
+        with self.lock:
+            self.rows.append((
+                time.time(),
+                vehicle_log['Location x'],
+                vehicle_log['Location y'],
+                vehicle_log['Speed (km/h)'],
+                vehicle_log['Heading'],
+                vehicle_log['Throttle'][0],
+                vehicle_log['Steer'][0],
+                vehicle_log['Brake'][0],
+                collision
+            ))
+
+    def save(self):
+        with self.lock:
+            rows = self.rows
+            self.rows = []
+        if rows:
+            self.archive.write(self.trip_id, self.leg, rows)
+
+
+def safe_name(trip_id):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(trip_id))
@@ -0,0 +1,65 @@
+import datetime
+
+
+class TripCheckpointStore(object):
+    """Lightweight per-leg checkpoints of driving trips, kept in Mongo so a
+    restarted server can resume them. The route is written once per leg
+    (and again after a re-plan); periodic checkpoints only update how many
+    route waypoints are left."""
+
+    def __init__(self, mongo_db):
+        self.collection = mongo_db.trip_checkpoints
+
+    def save_route(self, trip_id, vehicle_id, vehicle, leg, destination, waypoints_queue):
+        route = [
+            [w.transform.location.x, w.transform.location.y, w.transform.location.z, option.value]
+            for w, option in waypoints_queue
+        ]
+        self.collection.replace_one({"trip_id": trip_id}, {
+            "trip_id": trip_id,
+            "vehicle_id": vehicle_id,
+            "carla_actor_id": vehicle.id,
+            "leg": leg,
+            "destination": [destination.x, destination.y, destination.z],
+            "route": route,
+            "remaining": len(route),
+            "updated": datetime.datetime.now().isoformat()
+        }, upsert=True)
+
+    def update_progress(self, trip_id, remaining):
+        self.collection.update_one({"trip_id": trip_id}, {"$set": {
+            "remaining": remaining,
+            "updated": datetime.datetime.now().isoformat()
+        }})
+
+    def delete(self, trip_id):
+        self.collection.delete_one({"trip_id": trip_id})
+
+    def delete_all(self):
+        self.collection.delete_many({})
+
+    def find_all(self):
+        return list(self.collection.find({}))
+
+
+def remaining_route(checkpoint):
+    remaining = checkpoint['remaining']
+    return checkpoint['route'][-remaining:] if remaining > 0 else []
+
+
+# Waypoints a vehicle may have passed between the last periodic checkpoint
+# and a restart. Bounding the search keeps a route that loops back past the
+# same spot from resuming at its later visit.
+RECOVERY_SEARCH_WINDOW = 100
+
+
+def trim_passed_waypoints(route, location):
+    """Drops the route waypoints before the one nearest to location."""
+    window = route[:RECOVERY_SEARCH_WINDOW]
+    if not window:
+        return route
+    nearest = min(
+        range(len(window)),
+        key=lambda i: (window[i][0] - location.x) ** 2 + (window[i][1] - location.y) ** 2
+    )
+    return route[nearest:]
@@ -0,0 +1,67 @@
+import threading
+import collections
+
+DEFAULT_RETAINED_TRIPS = 1000
+
+
+class TripRegistry(object):
+    """Tracks the threads of trips that are currently driving and keeps a
+    bounded LRU of compact summaries for finished trip legs. Finished threads
+    are dropped so their agents and waypoint queues can be collected. On a
+    summary miss the trip record in Mongo is used instead."""
+
+    def __init__(self, mongo_db, capacity=DEFAULT_RETAINED_TRIPS):
+        self.mongo_db = mongo_db
+        self.capacity = capacity
+        self.live = {}
+        self.retained = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def start(self, trip_id, thread):
+        with self.lock:
+            self.live[trip_id] = thread
+            self.retained.pop(trip_id, None)
+        thread.start()
+
+    def finish(self, trip_id, leg, reached):
+        with self.lock:
+            self.live.pop(trip_id, None)
+            self.retained[trip_id] = {
+                "trip_id": trip_id,
+                "leg": leg,
+                "reached": reached
+            }
+            self.retained.move_to_end(trip_id)
+            while len(self.retained) > self.capacity:
+                self.retained.popitem(last=False)
+
+    def is_alive(self, trip_id):
+        thread = self.live.get(trip_id)
+        return thread is not None and thread.is_alive()
+
+    def get_summary(self, trip_id):
+        with self.lock:
+            if trip_id in self.retained:
+                self.retained.move_to_end(trip_id)
+                return self.retained[trip_id]
+
+        trip = self.mongo_db.trips.find_one({"trip_id": trip_id}, {"pickup_time": 1, "dropoff_time": 1})
+        if not trip:
+            return None
+        if 'dropoff_time' in trip:
+            return {"trip_id": trip_id, "leg": 'destination', "reached": True}
+        if 'pickup_time' in trip:
+            return {"trip_id": trip_id, "leg": 'pickup', "reached": True}
+        return None
+
+    def threads(self):
+        with self.lock:
+            return list(self.live.values())
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "live_trips": len([t for t in self.live.values() if t.is_alive()]),
+                "retained_trips": len(self.retained),
+                "retained_capacity": self.capacity
+            }
@@ -0,0 +1,156 @@
+import itertools
+import logging
+import multiprocessing
+import threading
+
+WORKER_REPLY_TIMEOUT = 60
+
+
+def run_trip_worker(worker_index, worker_count, config, mongo_uri, database, command_queue, result_queue):
+    """Entry point of a worker process. Each worker owns its own carla.Client
+    and Mongo connection and drives the trips of the vehicles routed to it."""
+    import carla
+    from pymongo import MongoClient
+    from .World import create_world
+
+    mongo_client = MongoClient(mongo_uri)
+    carla_client = carla.Client(config['Carla']['host'], config['Carla']['port'])
+    world = create_world(carla_client, mongo_client.get_database(database), config)
+    recovered = world.recover_trips(lambda vehicle_id: int(vehicle_id) % worker_count == worker_index)
+    logging.info("Trip worker %d ready, recovered trips: %s" % (worker_index, recovered))
+
+    while True:
+        request = command_queue.get()
+        if request is None:
+            world.kill_all_threads()
+            break
+
+        request_id, command, args = request
+        try:
+            result_queue.put((request_id, True, getattr(world, command)(*args)))
+        except Exception as e:
+            result_queue.put((request_id, False, '%s: %s' % (type(e).__name__, e)))
+
+
+class TripWorkerPool(object):
+    """Partitions trips by vehicle_id across worker processes so that the
+    control loops of different vehicles do not share one GIL. Exposes the
+    same trip methods as World so app.py can use either one. Trip status is
+    read from what the workers publish in Mongo, through the API process'
+    World, and never waits on a worker."""
+
+    def __init__(self, worker_count, config, mongo_uri, mongo_db, world):
+        self.mongo_db = mongo_db
+        self.world = world
+        self.request_ids = itertools.count()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+        ctx = multiprocessing.get_context('spawn')
+        self.result_queue = ctx.Queue()
+        self.workers = []
+        for i in range(worker_count):
+            command_queue = ctx.Queue()
+            process = ctx.Process(
+                target=run_trip_worker,
+                args=(i, worker_count, config, mongo_uri, mongo_db.name, command_queue, self.result_queue),
+                daemon=True
+            )
+            process.start()
+            self.workers.append((process, command_queue))
+
+        self.collector = threading.Thread(target=self.collect_results, daemon=True)
+        self.collector.start()
+
+    def collect_results(self):
+        while True:
+            request_id, ok, result = self.result_queue.get()
+            with self.pending_lock:
+                waiter = self.pending.pop(request_id, None)
+            if waiter is None:
+                # Caller already gave up waiting for this reply
+                continue
+            waiter['ok'] = ok
+            waiter['result'] = result
+            waiter['event'].set()
+
+    def call_worker(self, worker_index, command, *args):
+        request_id = next(self.request_ids)
+        waiter = {'event': threading.Event()}
+        with self.pending_lock:
+            self.pending[request_id] = waiter
+
+        process, command_queue = self.workers[worker_index]
+        if not process.is_alive():
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            raise RuntimeError('Trip worker %d is not running' % worker_index)
+
+        command_queue.put((request_id, command, args))
+        if not waiter['event'].wait(WORKER_REPLY_TIMEOUT):
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            raise RuntimeError('Trip worker %d timed out on %s' % (worker_index, command))
+
+        if not waiter['ok']:
+            raise RuntimeError(waiter['result'])
+        return waiter['result']
+
+    def worker_for_vehicle(self, vehicle_id):
+        return int(vehicle_id) % len(self.workers)
+
+    def worker_for_trip(self, trip_id):
+        trip = self.mongo_db.trips.find_one({'trip_id': trip_id}, {'vehicle_id': 1})
+        if not trip:
+            raise LookupError("Trip id does not exist")
+        return self.worker_for_vehicle(trip['vehicle_id'])
+
+    def trip_init(self, vehicle_id, trip_id, pickup_index, destination_index):
+        return self.call_worker(
+            self.worker_for_vehicle(vehicle_id),
+            'trip_init',
+            vehicle_id, trip_id, pickup_index, destination_index
+        )
+
+    def trip_to_pickup(self, trip_id, crash):
+        return self.call_worker(self.worker_for_trip(trip_id), 'trip_to_pickup', trip_id, crash)
+
+    def trip_to_destination(self, trip_id, crash):
+        return self.call_worker(self.worker_for_trip(trip_id), 'trip_to_destination', trip_id, crash)
+
+    def trip_status(self, trip_id):
+        return self.world.get_published_trip_status(trip_id)
+
+    def get_vehicle_trip(self, vehicle_id):
+        return self.call_worker(self.worker_for_vehicle(vehicle_id), 'get_vehicle_trip', vehicle_id)
+
+    def get_stats(self):
+        worker_stats = []
+        for i in range(len(self.workers)):
+            try:
+                worker_stats.append(self.call_worker(i, 'get_stats'))
+            except RuntimeError as e:
+                logging.warning("Failed to get stats from trip worker %d: %s" % (i, e))
+
+        return {
+            "workers": len(self.workers),
+            "workers_alive": len([p for p, _ in self.workers if p.is_alive()]),
+            "live_trips": sum(s['live_trips'] for s in worker_stats),
+            "retained_trips": sum(s['retained_trips'] for s in worker_stats),
+            "tick_lag_p50": max([s['tick_lag_p50'] for s in worker_stats] or [0]),
+            "tick_lag_p99": max([s['tick_lag_p99'] for s in worker_stats] or [0]),
+            "tick_lag_max": max([s['tick_lag_max'] for s in worker_stats] or [0]),
+            "tick_lag_samples": sum(s['tick_lag_samples'] for s in worker_stats),
+            "control_steps_run": sum(s['control']['steps_run'] for s in worker_stats),
+            "control_steps_skipped": sum(s['control']['steps_skipped'] for s in worker_stats),
+            "per_worker": worker_stats
+        }
+
+    def shutdown(self):
+        for process, command_queue in self.workers:
+            try:
+                command_queue.put(None)
+            except (OSError, ValueError):
+                pass
+        for process, _ in self.workers:
+            process.join(10)
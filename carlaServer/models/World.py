@@ -6,10 +6,17 @@ import datetime
 import logging
 import weakref
 import collections
+import threading
 import requests
-from agents.navigation.basic_agent import BasicAgent
-from agents.navigation.behavior_agent import BehaviorAgent
 from .StoppableThread import StoppableThread
+from .WorldCache import load_world_metadata
+from .RoadIndex import RoadIndex
+from .FleetSnapshot import FleetSnapshot
+from .TrajectoryArchive import TrajectoryArchive
+from .TripCheckpoint import TripCheckpointStore, remaining_route, trim_passed_waypoints
+from .FleetIdlePolicy import FleetIdlePolicy
+from .TripRegistry import TripRegistry, DEFAULT_RETAINED_TRIPS
+from .ControlScheduler import ControlScheduler, create_control_scheduler
 
 SPAWNING_RETRIES = 15
 
@@ -18,6 +25,8 @@ STALE_ERROR_OUT = 30 #30 seconds
 WAYPOINT_TO_MILES_RATIO = 1/400
 
 STALE_THRESHOLD = STALE_ERROR_OUT / TICK_FREQUENCY # 30 seconds
+TICK_LAG_SAMPLES = 2000
+CHECKPOINT_INTERVAL = 5 # seconds between trip progress checkpoints
 
 AVAILABLE_CAR_BRAND = ['audi','mercedes', 'chevrolet', 'tesla', 'dodge', 'ford', 'lincoln','mini','volkswagen','toyota','nissan','bmw']
 VEHICLE_ID = "vehicle_id"
@@ -35,24 +44,33 @@ TRIP_STATUS = {
 
 
 class World(object):
-    def __init__ (self, carla_world, mongo_client, node_url):
+    def __init__ (self, carla_world, mongo_client, node_url, cache_dir=None, idle_policy=None, control_scheduler=None, retained_trips=DEFAULT_RETAINED_TRIPS, archive_dir=None):
         self.world = carla_world
-        self.spawn_points = self.world.get_map().get_spawn_points()
-        self.vehicle_bps = []
+        self.map = self.world.get_map()
 
-
-        for c in AVAILABLE_CAR_BRAND:
-            for v in self.world.get_blueprint_library().filter('vehicle.*'):
-                if c in v.id:
-                    self.vehicle_bps.append(v)
+        # Blueprint ids, spawn points and lane waypoints are static per map, so
+        # they are read from the on-disk cache when available.
+        blueprint_library = self.world.get_blueprint_library()
+        self.metadata = load_world_metadata(self.map, blueprint_library, AVAILABLE_CAR_BRAND, cache_dir)
+        self.spawn_points = self.metadata.spawn_point_transforms()
+        self.vehicle_bps = [blueprint_library.find(bp_id) for bp_id in self.metadata.blueprint_ids]
+        self.road_index = RoadIndex(self.metadata.lane_waypoints)
 
         self.mongo_db = mongo_client
         self.mongo_db.vehicles.create_index('vehicle_id', unique=True)
         self.mongo_db.trips.create_index('trip_id', unique=True)
+        self.mongo_db.trip_checkpoints.create_index('trip_id', unique=True)
+        self.trip_checkpoints = TripCheckpointStore(self.mongo_db)
+        self.shutting_down = threading.Event()
 
         self.node_url = node_url
+        self.idle_policy = idle_policy or FleetIdlePolicy()
+        self.control_scheduler = control_scheduler or ControlScheduler(self.world)
 
-        self.trips = {}
+        self.trip_registry = TripRegistry(self.mongo_db, retained_trips)
+        self.fleet_snapshot = FleetSnapshot(self.world, self.mongo_db)
+        self.trajectory_archive = TrajectoryArchive(archive_dir) if archive_dir else None
+        self.tick_lags = collections.deque(maxlen=TICK_LAG_SAMPLES)
 
     def add_vehicle(self, vehicle_id, spawn_point_index=None):
         vehicle_bp = random.choice(self.vehicle_bps)
@@ -78,9 +96,9 @@ class World(object):
         if sim_vehicle == None:
             raise RuntimeError('Failed to create vehicle in carla')
 
-        sim_vehicle.set_autopilot(True)
-
         self.mongo_db.vehicles.insert_one(create_vehicle_record(vehicle_id, sim_vehicle))
+        self.fleet_snapshot.add(vehicle_id, sim_vehicle)
+        self.idle_policy.release(sim_vehicle)
 
         return get_carla_vehicle_info(vehicle_id, sim_vehicle)
     
@@ -94,16 +112,17 @@ class World(object):
         logging.info('Successfully destroyed: ', carla_vehicle.destroy())
 
         self.mongo_db.vehicles.update_one({VEHICLE_ID: vehicle_id}, {"$set":{"destroyed": True}})
+        self.fleet_snapshot.remove(vehicle_id)
         return True
 
     # Return a list of (vehicle_id, location(x,y))
-    def get_nearest_vehicles(self, spawn_point_index, number_of_vehicles):
+    def get_nearest_vehicles(self, target, number_of_vehicles):
         if number_of_vehicles <= 0:
             return []
 
         vehicle_records = list(self.mongo_db.vehicles.find({"destroyed": False}))
         carla_vehicles = self.world.get_actors([v[CARLA_VEHICLE_ID] for v in vehicle_records])
-        target_location = self.spawn_points[spawn_point_index].location
+        target_location = self.resolve_location(target)
         distances = [
             (i, get_distance(target_location, carla_vehicles.__getitem__(i).get_location()))
             for i in range(len(carla_vehicles))
@@ -133,7 +152,7 @@ class World(object):
         for t in trips:
             if t['status'] == TRIP_STATUS[2]:
                 trip_id = t[TRIP_ID]
-                if trip_id in self.trips and self.trips[trip_id].is_alive():
+                if self.trip_registry.is_alive(trip_id):
                     del t['_id']
                     return t
             else: 
@@ -141,7 +160,7 @@ class World(object):
 
         return None
 
-    def trip_init(self, vehicle_id, trip_id, pickup_index, destination_index): 
+    def trip_init(self, vehicle_id, trip_id, pickup, destination): 
         in_progress_trip = self.mongo_db.trips.find_one({
             "vehicle_id": vehicle_id,
             "status": {
@@ -157,14 +176,14 @@ class World(object):
         except:
             return "Vehicle with id [%s] does not exist" % (vehicle_id)
 
-        actor.set_autopilot(False)
+        self.claim_vehicle(vehicle_id, actor)
         actor.apply_control(carla.VehicleControl(brake=1.0, throttle=0))
 
         self.mongo_db.trips.insert_one(create_trip_record(
             vehicle_id,
             trip_id,
-            pickup_index,
-            destination_index,
+            pickup,
+            destination,
         ))
 
 
@@ -174,29 +193,23 @@ class World(object):
             raise RuntimeError('Trip not in standby status')
         
         agent = self.get_carla_agent(trip['vehicle_id'])
-        pickup_location = self.spawn_points[trip['pickup_index']].location
+        pickup_location = self.get_trip_location(trip, 'pickup')
 
         agent.set_destination(pickup_location)    
         waypoints_length = get_remaining_waypoint_count(agent)
 
-        def completion_cb():            
-            print("Calling to pickup completion callback")
-            requests.put(self.node_url + '/trip/edit/' + str(trip_id), {
-                'atPickUp': '1',
-            })
-
-
-        new_thread = StoppableThread(target=self.trace_route, args=(
+        new_thread = StoppableThread(target=self.run_trip_leg, args=(
+            'pickup',
             trip['vehicle_id'], 
             agent, 
             pickup_location,
             trip_id, 
             crash,
-            completion_cb
+            self.get_completion_cb('pickup', trip_id, trip['vehicle_id'], agent._vehicle)
         ))
 
-        self.trips[trip_id] = new_thread
-        new_thread.start()
+        self.publish_trip_progress(trip_id, True, waypoint_count_to_eta(waypoints_length))
+        self.trip_registry.start(trip_id, new_thread)
 
         self.mongo_db.trips.update_one({TRIP_ID: trip_id}, {"$set": {
             'status': TRIP_STATUS[1]
@@ -208,39 +221,23 @@ class World(object):
         trip = self.mongo_db.trips.find_one({TRIP_ID: trip_id})
         if trip['status'] != TRIP_STATUS[1]:
             raise RuntimeError('Car is not in correct status')
-        elif self.trips[trip_id].is_alive():
+        elif self.trip_registry.is_alive(trip_id):
             raise RuntimeError('Car has not reached pickup location')
 
         agent = self.get_carla_agent(trip['vehicle_id'])
-        destination_location = self.spawn_points[trip['destination_index']].location
+        destination_location = self.get_trip_location(trip, 'destination')
 
         agent.set_destination(destination_location)    
         waypoints_length = get_remaining_waypoint_count(agent)
 
-        def completion_cb():   
-            print("Calling to destination completion callback")
-
-            vehicle = agent._vehicle       
-            completed_trip = self.mongo_db.trips.find_one({TRIP_ID: trip_id})
-
-            requests.put(self.node_url + '/trip/edit/' + str(trip_id), {
-                'iscompleted': '1',
-                'miles': completed_trip['miles']
-            })
-
-            time.sleep(10)
-            vehicle.set_autopilot(True)
-            print("Set vehicle back to autopilot: ", vehicle.id)
-
-        
-
-        new_thread = StoppableThread(target=self.trace_route, args=(
+        new_thread = StoppableThread(target=self.run_trip_leg, args=(
+            'destination',
             trip['vehicle_id'], 
             agent, 
             destination_location,
             trip_id,
             crash,
-            completion_cb
+            self.get_completion_cb('destination', trip_id, trip['vehicle_id'], agent._vehicle)
         ))
         
         self.mongo_db.trips.update_one({TRIP_ID: trip_id}, {"$set": {
@@ -248,19 +245,62 @@ class World(object):
             'miles': WAYPOINT_TO_MILES_RATIO * waypoints_length
         }})
 
-        self.trips[trip_id] = new_thread
-        new_thread.start()
+        self.publish_trip_progress(trip_id, True, waypoint_count_to_eta(waypoints_length))
+        self.trip_registry.start(trip_id, new_thread)
 
         return waypoints_length
 
+    def get_completion_cb(self, leg, trip_id, vehicle_id, vehicle):
+        def pickup_completion_cb():            
+            print("Calling to pickup completion callback")
+            requests.put(self.node_url + '/trip/edit/' + str(trip_id), {
+                'atPickUp': '1',
+            })
+
+        def destination_completion_cb():   
+            print("Calling to destination completion callback")
+
+            completed_trip = self.mongo_db.trips.find_one({TRIP_ID: trip_id})
+
+            requests.put(self.node_url + '/trip/edit/' + str(trip_id), {
+                'iscompleted': '1',
+                'miles': completed_trip['miles']
+            })
+
+            time.sleep(10)
+            self.release_vehicle(vehicle_id, vehicle)
+            print("Set vehicle back to autopilot: ", vehicle.id)
+
+        return pickup_completion_cb if leg == 'pickup' else destination_completion_cb
+
     def trip_status(self, trip_id):
+        is_alive = self.trip_registry.is_alive(trip_id)
+        if not is_alive:
+            summary = self.trip_registry.get_summary(trip_id)
+            if summary and summary['leg'] == 'destination':
+                return {
+                    'status': 'FINISHED'
+                }
+
         trip = self.mongo_db.trips.find_one({TRIP_ID: trip_id})
-        print(TRIP_ID, trip_id, type(trip_id), trip)
         if not trip:
             raise LookupError("Trip id does not exist")
 
+        return self.build_trip_status(trip, is_alive, lambda: self.check_eta(trip))
+
+    # Status as published in Mongo by the process driving the trip, so it can
+    # be answered from any process without touching the simulator
+    def get_published_trip_status(self, trip_id):
+        trip = self.mongo_db.trips.find_one({TRIP_ID: trip_id})
+        if not trip:
+            raise LookupError("Trip id does not exist")
 
-        print(self.trips[trip_id])
+        # A driving flag that stopped being refreshed belongs to a dead process
+        is_alive = trip.get('driving', False) and \
+            time.time() - trip.get('progress_updated', 0) < STALE_ERROR_OUT
+        return self.build_trip_status(trip, is_alive, lambda: trip.get('eta'))
+
+    def build_trip_status(self, trip, is_alive, get_eta):
         if trip['status'] == TRIP_STATUS[0]:
             return {
                 "status": 'STANDBY'
@@ -269,8 +309,8 @@ class World(object):
         incident = self.check_collision(trip['trip_id'], trip['vehicle_id'])
 
         if trip['status'] == TRIP_STATUS[1]:
-            if self.trips[trip_id].is_alive():
-                eta = self.check_eta(trip)
+            if is_alive:
+                eta = get_eta()
                 return {
                     "status":'TO_PICKUP',
                     "eta": eta,
@@ -282,8 +322,8 @@ class World(object):
                     'incident': incident
                 }
         else:
-            if self.trips[trip_id].is_alive():
-                eta = self.check_eta(trip)
+            if is_alive:
+                eta = get_eta()
                 return {
                     'status': 'TO_DESTINATION',
                     'eta': eta,
@@ -294,6 +334,27 @@ class World(object):
                     'status': 'FINISHED'
                 }
 
+    # Thread target for one leg of a trip. The leg is moved from the live set
+    # to the finished summaries on every exit path.
+    def run_trip_leg(self, leg, vehicle_id, agent, destination, trip_id, crash, completion_cb):
+        reached = False
+        recorder = self.trajectory_archive.new_recorder(trip_id, leg) if self.trajectory_archive else None
+        try:
+            if agent is None:
+                # Recovered leg that reached its stop point before the restart
+                self.complete_trip_leg(trip_id, completion_cb)
+                reached = True
+            else:
+                reached = self.trace_route(vehicle_id, agent, destination, trip_id, crash, completion_cb, recorder, leg)
+        finally:
+            if recorder:
+                recorder.save()
+            # On shutdown the checkpoint is kept so the leg resumes after restart
+            if not self.shutting_down.is_set():
+                self.trip_checkpoints.delete(trip_id)
+                self.publish_trip_progress(trip_id, False)
+            self.trip_registry.finish(trip_id, leg, bool(reached))
+
     def trace_route(
         self, 
         vehicle_id, 
@@ -301,7 +362,9 @@ class World(object):
         destination, 
         trip_id, 
         crash, 
-        completion_cb
+        completion_cb,
+        recorder=None,
+        leg=None
     ):
         waypoints_queue = agent.get_local_planner()._waypoints_queue
         vehicle = agent._vehicle
@@ -314,76 +377,116 @@ class World(object):
                 "timestamp": get_current_timestamp()
         })
 
+        # Wake the car in case the dormancy updater froze it right before the claim
+        self.idle_policy.claim(vehicle)
         collision_sensor = CollisionSensor(vehicle, log_collision)
 
-        iteration_counter = 0 
+        try:
+            iteration_counter = 0 
+
+            if crash:
+                iterations = int(10 / TICK_FREQUENCY)
+                for i in range(iterations):
+                    vehicle.apply_control(carla.VehicleControl(brake=0, throttle=1, steer=0.1))
+                    self.log_vehicle_info_to_db(vehicle_id, trip_id, vehicle, collision_sensor, recorder)
+                    time.sleep(TICK_FREQUENCY)
+                    iteration_counter += 1
+
+                    if iteration_counter % 10 == 0:
+                        incident = self.check_collision(trip_id, vehicle_id)
+                        if incident:
+                            self.log_incident_in_node(trip_id, incident)
+
+                return
+
+            stale_count = {}
+            schedule = self.control_scheduler.new_schedule()
+            self.trip_checkpoints.save_route(trip_id, vehicle_id, vehicle, leg, destination, waypoints_queue)
+            last_tick = time.time()
+            while len(waypoints_queue) > CARLA_STOP_DISTANCE:
+                if self.shutting_down.is_set():
+                    vehicle.apply_control(carla.VehicleControl(brake=1.0, throttle=0))
+                    return
 
-        if crash:
-            iterations = int(10 / TICK_FREQUENCY)
-            for i in range(iterations):
-                vehicle.apply_control(carla.VehicleControl(brake=0, throttle=1, steer=0.1))
-                self.log_vehicle_info_to_db(vehicle_id, trip_id, vehicle, collision_sensor)
-                time.sleep(TICK_FREQUENCY)
+                # Track how late each control step runs compared to the tick period
+                now = time.time()
+                if iteration_counter > 0:
+                    self.tick_lags.append(max(0, now - last_tick - TICK_FREQUENCY))
+                last_tick = now
+
+                waypoints_left = len(waypoints_queue)
+                if waypoints_left in stale_count:
+                    stale_count[waypoints_left] += 1
+                else:
+                    stale_count[waypoints_left] = 1
+
+                if stale_count[waypoints_left] > STALE_THRESHOLD:
+                    logging.error("Vehicle [%d] stale for more than %f seconds. Teleport to \
+                        new starting point" % 
+                        (vehicle.id, STALE_THRESHOLD/10))
+                    self.random_teleport_vehicle(vehicle)
+                    agent.set_destination(destination)
+                    vehicle.apply_control(carla.VehicleControl(brake=1.0, throttle=0, steer=0))
+                    waypoints_queue = agent.get_local_planner()._waypoints_queue
+                    stale_count = {}
+                    schedule = self.control_scheduler.new_schedule()
+                    self.trip_checkpoints.save_route(trip_id, vehicle_id, vehicle, leg, destination, waypoints_queue)
+                    continue
+
+                # On skipped ticks the last applied control stays in effect
+                if schedule.should_step(vehicle, waypoints_queue):
+                    self.log_vehicle_info_to_db(vehicle_id, trip_id, vehicle, collision_sensor, recorder)
+
+                    control = agent.run_step()
+                    vehicle.apply_control(control)
                 iteration_counter += 1
 
                 if iteration_counter % 10 == 0:
                     incident = self.check_collision(trip_id, vehicle_id)
                     if incident:
                         self.log_incident_in_node(trip_id, incident)
+                        return
 
-            return
-
-        stale_count = {}
-        while len(waypoints_queue) > CARLA_STOP_DISTANCE:
-            waypoints_left = len(waypoints_queue)
-            if waypoints_left in stale_count:
-                stale_count[waypoints_left] += 1
-            else:
-                stale_count[waypoints_left] = 1
-
-            if stale_count[waypoints_left] > STALE_THRESHOLD:
-                logging.error("Vehicle [%d] stale for more than %f seconds. Teleport to \
-                    new starting point" % 
-                    (vehicle.id, STALE_THRESHOLD/10))
-                self.random_teleport_vehicle(vehicle)
-                agent.set_destination(destination)
-                vehicle.apply_control(carla.VehicleControl(brake=1.0, throttle=0, steer=0))
-                waypoints_queue = agent.get_local_planner()._waypoints_queue
-                stale_count = {}
-                continue
-            
-            self.log_vehicle_info_to_db(vehicle_id, trip_id, vehicle, collision_sensor)
-
-            control = agent.run_step()
-            vehicle.apply_control(control)
-            iteration_counter += 1
-
-            if iteration_counter % 10 == 0:
-                incident = self.check_collision(trip_id, vehicle_id)
-                if incident:
-                    self.log_incident_in_node(trip_id, incident)
-                    return
+                if iteration_counter % int(1/TICK_FREQUENCY) == 0:
+                    self.one_second_cb(trip_id)
 
-            if iteration_counter % int(1/TICK_FREQUENCY) == 0:
-                self.one_second_cb(trip_id)
+                if iteration_counter % int(CHECKPOINT_INTERVAL/TICK_FREQUENCY) == 0:
+                    self.trip_checkpoints.update_progress(trip_id, len(waypoints_queue))
 
-            time.sleep(TICK_FREQUENCY)
+                time.sleep(TICK_FREQUENCY)
         
-        vehicle.apply_control(carla.VehicleControl(brake=0))
-        logging.info("Destination reached", {'vehicle_id': vehicle.id})
-
+            vehicle.apply_control(carla.VehicleControl(brake=0))
+            logging.info("Destination reached", {'vehicle_id': vehicle.id})
+
+            self.complete_trip_leg(trip_id, completion_cb)
+            return True
+        finally:
+            # The only place the sensor is released, on every exit path
+            collision_sensor.destroy()
+            
+    def complete_trip_leg(self, trip_id, completion_cb):
         self.update_trip_in_db(trip_id)
-        collision_sensor.destroy()
         completion_cb()
-            
+
     def one_second_cb(self, trip_id):
         newest_trip = self.mongo_db.trips.find_one({TRIP_ID: trip_id})
+        eta = self.check_eta(newest_trip)
+        self.publish_trip_progress(trip_id, True, eta)
 
         requests.put(self.node_url + '/trip/edit/' + str(trip_id), {
-            'eta': self.check_eta(newest_trip)
+            'eta': eta
         })
 
-    def log_vehicle_info_to_db(self, vehicle_id, trip_id, vehicle, collision_sensor): 
+    def publish_trip_progress(self, trip_id, driving, eta=None):
+        progress = {
+            'driving': driving,
+            'progress_updated': time.time()
+        }
+        if eta is not None:
+            progress['eta'] = eta
+        self.mongo_db.trips.update_one({TRIP_ID: trip_id}, {"$set": progress})
+
+    def log_vehicle_info_to_db(self, vehicle_id, trip_id, vehicle, collision_sensor, recorder=None): 
         frame = self.world.get_snapshot().frame
 
         vel = vehicle.get_velocity()
@@ -396,7 +499,7 @@ class World(object):
         colhist = collision_sensor.get_collision_history()
         collision = [colhist[x + frame - 200] for x in range(0, 200)]
 
-        self.mongo_db.vehicle_log.insert_one({
+        vehicle_log = {
             "vehicle_id": vehicle_id,
             "trip_id": trip_id,
             "Speed (km/h)": (3.6 * math.sqrt(vel.x**2 + vel.y**2 + vel.z**2)),
@@ -410,7 +513,10 @@ class World(object):
             "Reverse": control.reverse,
             "Collision": collision,
             "timestamp": get_current_timestamp()
-        })
+        }
+        if recorder:
+            recorder.record(vehicle_log)
+        self.mongo_db.vehicle_log.insert_one(vehicle_log)
 
 
     def update_trip_in_db(self, trip_id):
@@ -430,6 +536,7 @@ class World(object):
         print("Run 1 step")
 
     def get_waypoint_to_location(self, carla_vehicle, destination):
+        from agents.navigation.basic_agent import BasicAgent
         agent = BasicAgent(carla_vehicle)
         agent.set_destination(destination)
         return get_remaining_waypoint_count(agent)
@@ -437,9 +544,9 @@ class World(object):
 
     def check_eta(self, trip):        
         if trip['status'] == TRIP_STATUS[1]:
-            target_location = self.spawn_points[trip['pickup_index']].location
+            target_location = self.get_trip_location(trip, 'pickup')
         else: 
-            target_location = self.spawn_points[trip['destination_index']].location 
+            target_location = self.get_trip_location(trip, 'destination')
 
         return waypoint_count_to_eta(self.get_waypoint_to_location(
             self.get_carla_vehicle_actor(trip['vehicle_id']),
@@ -463,6 +570,78 @@ class World(object):
         })
 
 
+    # Snap an arbitrary map coordinate to the nearest driving lane point,
+    # None when it is off the map
+    def snap_to_road(self, x, y):
+        return self.road_index.nearest(x, y)
+
+    def geolocation_to_road(self, lat, lon):
+        x, y = self.metadata.geo_reference.to_map(lat, lon)
+        return self.snap_to_road(x, y)
+
+    # A target is either a spawn point index or a snapped (x, y, z) point
+    def resolve_location(self, target):
+        if isinstance(target, int):
+            return self.spawn_points[target].location
+        return carla.Location(x=target[0], y=target[1], z=target[2])
+
+    def get_trip_location(self, trip, leg):
+        if leg + '_point' in trip:
+            return self.resolve_location(trip[leg + '_point'])
+        return self.resolve_location(trip[leg + '_index'])
+
+    # Resume legs that were driving when the server stopped. The existing
+    # CARLA actors are reattached and follow the checkpointed route, so no
+    # route planning or world reset is needed.
+    def recover_trips(self, owns_vehicle=None):
+        from agents.navigation.behavior_agent import BehaviorAgent
+        from agents.navigation.local_planner import RoadOption
+
+        recovered = []
+        for checkpoint in self.trip_checkpoints.find_all():
+            trip_id = checkpoint[TRIP_ID]
+            vehicle_id = checkpoint[VEHICLE_ID]
+            if owns_vehicle and not owns_vehicle(vehicle_id):
+                continue
+            if self.trip_registry.is_alive(trip_id):
+                continue
+
+            actor = self.world.get_actor(checkpoint[CARLA_VEHICLE_ID])
+            route = remaining_route(checkpoint)
+            if actor is not None:
+                # The vehicle kept driving after the last periodic checkpoint
+                route = trim_passed_waypoints(route, actor.get_location())
+            if actor is None:
+                logging.warning("Dropping checkpoint of trip %s, vehicle gone" % trip_id)
+                self.trip_checkpoints.delete(trip_id)
+                self.publish_trip_progress(trip_id, False)
+                continue
+
+            # A leg already at its stop point, possibly stopped in the middle
+            # of its completion, only runs the completion again
+            agent = None
+            if len(route) > CARLA_STOP_DISTANCE:
+                agent = BehaviorAgent(actor)
+                agent.set_global_plan([
+                    (self.map.get_waypoint(carla.Location(x=p[0], y=p[1], z=p[2])), RoadOption(p[3]))
+                    for p in route
+                ])
+            destination = carla.Location(*checkpoint['destination'])
+
+            new_thread = StoppableThread(target=self.run_trip_leg, args=(
+                checkpoint['leg'],
+                vehicle_id,
+                agent,
+                destination,
+                trip_id,
+                False,
+                self.get_completion_cb(checkpoint['leg'], trip_id, vehicle_id, actor)
+            ))
+            self.trip_registry.start(trip_id, new_thread)
+            recovered.append(trip_id)
+
+        return recovered
+
     def get_random_spawn_point(self):
         return random.choice(self.spawn_points)
 
@@ -481,11 +660,13 @@ class World(object):
         return carla_actor
 
     def get_carla_agent(self, vehicle_id):
+        from agents.navigation.behavior_agent import BehaviorAgent
         carla_actor = self.get_carla_vehicle_actor(vehicle_id)
         return BehaviorAgent(carla_actor)
 
     def kill_all_threads(self):
-        for t in self.trips.values:
+        self.shutting_down.set()
+        for t in self.trip_registry.threads():
             t.stop()
             t.join()
     
@@ -501,6 +682,28 @@ class World(object):
         vehicle_spawn_point = self.get_random_spawn_point()
         vehicle.set_transform(vehicle_spawn_point)
 
+    def claim_vehicle(self, vehicle_id, actor):
+        # Flag first so the dormancy updater never freezes a claimed car
+        self.mongo_db.vehicles.update_one({VEHICLE_ID: vehicle_id}, {"$set": {"in_trip": True}})
+        self.idle_policy.claim(actor)
+
+    def release_vehicle(self, vehicle_id, actor):
+        self.idle_policy.release(actor)
+        self.mongo_db.vehicles.update_one({VEHICLE_ID: vehicle_id}, {"$set": {"in_trip": False}})
+
+    def get_fleet_actor_ids(self):
+        idle_ids = []
+        active_ids = []
+        for v in self.mongo_db.vehicles.find({"destroyed": False}, {CARLA_VEHICLE_ID: 1, "in_trip": 1}):
+            if v.get('in_trip', False):
+                active_ids.append(v[CARLA_VEHICLE_ID])
+            else:
+                idle_ids.append(v[CARLA_VEHICLE_ID])
+        return idle_ids, active_ids
+
+    def start_idle_policy(self):
+        self.idle_policy.start(self.world, self.get_fleet_actor_ids)
+
     def get_vehicle(self, vehicle_id):
         try:
             vehicle = self.get_carla_vehicle_actor(vehicle_id)
@@ -508,27 +711,56 @@ class World(object):
         except:
             return None
 
-    def get_all_vehicles(self):
-        vehicle_records = list(self.mongo_db.vehicles.find({"destroyed": False}))
-        results = []
-        for v in vehicle_records:
-            actor = self.world.get_actor(v['carla_actor_id'])
-            if actor:
-                results.append(get_carla_vehicle_info(v['vehicle_id'],actor))
-            else:
-                logging.warning('Missing carla vehicle', extra={
-                    "vehicle_id": v['vehicle_id'],
-                    "carla_id": v['carla_actor_id']
-                })
-        return results
+    # Served from the per-tick fleet snapshot, see FleetSnapshot
+    def get_all_vehicles(self, cursor=None, limit=None, fields=None):
+        return self.fleet_snapshot.get_page(cursor, limit, fields)
     
+    def get_stats(self):
+        lags = sorted(self.tick_lags)
+        stats = self.trip_registry.get_stats()
+        stats.update({
+            "tick_lag_p50": percentile(lags, 50),
+            "tick_lag_p99": percentile(lags, 99),
+            "tick_lag_max": lags[-1] if lags else 0,
+            "tick_lag_samples": len(lags),
+            "idle_policy": self.idle_policy.get_stats(),
+            "control": self.control_scheduler.get_stats()
+        })
+        return stats
+
+    def get_trip_trajectory(self, trip_id, max_points=None):
+        if not self.trajectory_archive:
+            return None
+        return self.trajectory_archive.get_trajectory(trip_id, max_points)
+
+    def get_trip_trajectory_stats(self, trip_id):
+        if not self.trajectory_archive:
+            return None
+        return self.trajectory_archive.get_stats(trip_id)
+
     def reset_all_vehicles_and_trips(self):
         all_vehicles = self.world.get_actors().filter('vehicle.*')
         for car in all_vehicles:
             car.destroy()
         self.mongo_db.vehicles.delete_many({})
         self.mongo_db.trips.delete_many({})
+        self.trip_checkpoints.delete_all()
+        self.fleet_snapshot.clear()
     
+# Build a World and its policies from the parsed config.yaml
+def create_world(carla_client, mongo_db, config):
+    carla_world = carla_client.get_world()
+    return World(
+        carla_world,
+        mongo_db,
+        config['Node']['url'],
+        config.get('Cache', {}).get('dir'),
+        FleetIdlePolicy(carla_client, config.get('Fleet', {})),
+        create_control_scheduler(carla_world, config.get('Control', {})),
+        config.get('Trips', {}).get('retained_summaries', DEFAULT_RETAINED_TRIPS),
+        config.get('Archive', {}).get('dir')
+    )
+
 def get_current_timestamp():
     return datetime.datetime.now().isoformat()
 
@@ -539,18 +771,23 @@ def create_vehicle_record(vehicle_id, carla_vehicle):
         "type_id": carla_vehicle.type_id,
         "created": get_current_timestamp(),
         "updated": get_current_timestamp(),
-        "destroyed": False
+        "destroyed": False,
+        "in_trip": False
     }
 
-def create_trip_record(vehicle_id, trip_id, pickup_index, destination_index):
-    return {
+def create_trip_record(vehicle_id, trip_id, pickup, destination):
+    record = {
         VEHICLE_ID: vehicle_id,
         TRIP_ID: trip_id,
-        'pickup_index': pickup_index,
-        'destination_index': destination_index,
         'status': TRIP_STATUS[0],
         'initiate_time': get_current_timestamp()
     }
+    for leg, target in (('pickup', pickup), ('destination', destination)):
+        if isinstance(target, int):
+            record[leg + '_index'] = target
+        else:
+            record[leg + '_point'] = list(target)
+    return record
 
 def get_distance(location1, location2):
     return location1.distance(location2)
@@ -571,6 +808,13 @@ def get_carla_vehicle_info(vehicle_id, carla_vehicle):
 def get_remaining_waypoint_count(agent):
     return len(agent.get_local_planner()._waypoints_queue)
 
+# Nearest-rank percentile of an already sorted list
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    index = int(math.ceil(p / 100 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(index, len(sorted_values) - 1))]
+
 
 
 class CollisionSensor(object):
@@ -612,7 +856,11 @@ class CollisionSensor(object):
             self.history.pop(0)
 
     def destroy(self):
+        if self.sensor is None:
+            return
+        self.sensor.stop()
         self.sensor.destroy()
+        self.sensor = None
 
 def waypoint_count_to_eta(waypoint_count):
     return 5*waypoint_count
\ No newline at end of file
@@ -0,0 +1,118 @@
+import os
+import re
+import json
+import logging
+import carla
+from .RoadIndex import GeoReference
+
+CACHE_VERSION = 3
+LANE_WAYPOINT_DISTANCE = 2.0 # meters between indexed lane waypoints
+
+
+class WorldMetadata(object):
+    """Static per-map data (vehicle blueprint ids, spawn points and lane
+    waypoints) that is expensive to fetch from the simulator on every start.
+    Stored on disk keyed by map name."""
+
+    def __init__(self, map_name, blueprint_ids, spawn_points, lane_waypoints, geo_reference):
+        self.map_name = map_name
+        self.blueprint_ids = blueprint_ids
+        # (x, y, z, pitch, yaw, roll) per spawn point
+        self.spawn_points = spawn_points
+        # (x, y, z) of driving lane waypoints, used for road snapping
+        self.lane_waypoints = lane_waypoints
+        self.geo_reference = geo_reference
+
+    def spawn_point_transforms(self):
+        return [
+            carla.Transform(
+                carla.Location(x=sp[0], y=sp[1], z=sp[2]),
+                carla.Rotation(pitch=sp[3], yaw=sp[4], roll=sp[5])
+            )
+            for sp in self.spawn_points
+        ]
+
+    def to_dict(self):
+        return {
+            "version": CACHE_VERSION,
+            "map_name": self.map_name,
+            "blueprint_ids": self.blueprint_ids,
+            "spawn_points": self.spawn_points,
+            "lane_waypoints": self.lane_waypoints,
+            "geo_reference": self.geo_reference.to_list()
+        }
+
+
+def load_world_metadata(carla_map, blueprint_library, car_brands, cache_dir=None):
+    cache_path = get_cache_path(cache_dir, carla_map.name) if cache_dir else None
+
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as f:
+                cached = json.load(f)
+            # Blueprints can disappear after a simulator upgrade, in which
+            # case the cache is rebuilt
+            available_ids = set(bp.id for bp in blueprint_library.filter('vehicle.*'))
+            blueprints_valid = set(cached.get('blueprint_ids', [])) <= available_ids
+            if cached.get('version') == CACHE_VERSION and not blueprints_valid:
+                logging.warning("World cache %s references missing blueprints, rebuilding" % cache_path)
+            elif cached.get('version') == CACHE_VERSION:
+                return WorldMetadata(
+                    cached['map_name'],
+                    cached['blueprint_ids'],
+                    cached['spawn_points'],
+                    cached['lane_waypoints'],
+                    GeoReference.from_list(cached['geo_reference'])
+                )
+        except (ValueError, KeyError, OSError) as e:
+            logging.warning("Ignoring unreadable world cache %s: %s" % (cache_path, e))
+
+    metadata = build_world_metadata(carla_map, blueprint_library, car_brands)
+
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(metadata.to_dict(), f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logging.warning("Failed to write world cache %s: %s" % (cache_path, e))
+
+    return metadata
+
+
+def build_world_metadata(carla_map, blueprint_library, car_brands):
+    blueprint_ids = []
+    for c in car_brands:
+        for v in blueprint_library.filter('vehicle.*'):
+            if c in v.id:
+                blueprint_ids.append(v.id)
+
+    spawn_points = [
+        (t.location.x, t.location.y, t.location.z, t.rotation.pitch, t.rotation.yaw, t.rotation.roll)
+        for t in carla_map.get_spawn_points()
+    ]
+
+    lane_waypoints = [
+        location_to_tuple(w.transform.location)
+        for w in carla_map.generate_waypoints(LANE_WAYPOINT_DISTANCE)
+        if w.lane_type == carla.LaneType.Driving
+    ]
+
+    return WorldMetadata(
+        carla_map.name,
+        blueprint_ids,
+        spawn_points,
+        lane_waypoints,
+        GeoReference.fit(carla_map)
+    )
+
+
+def get_cache_path(cache_dir, map_name):
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', map_name)
+    return os.path.join(cache_dir, 'world_%s.json' % safe_name)
+
+
+def location_to_tuple(location):
+    return (location.x, location.y, location.z)